@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import asyncio
+import collections
+import fcntl
 import logging
-import requests
+import orjson
+import mmap
 import random
-import time
 import os
+import shlex
 import subprocess
 
 # This command will be called to change the background
@@ -20,7 +24,17 @@ BG_CHANGE_OPT_CENTER = "--bg-center"
 # Miscellaneous options
 ALLOW_STICKIES = False # Set to True to allow images from stickies
 DISALLOWED_EXTENSIONS = ['.webm']
-SLEEP_FAILURE = 1 # Seconds to sleep between failed attempts to find bg
+SLEEP_FAILURE = 1 # Seconds to sleep per API request of a failed search
+SCAN_WORKERS = 8 # Number of threads to search concurrently for an image
+POST_PROBES = 20 # Random posts checked before filtering a whole thread
+MAX_CONNECTIONS = 16 # Maximum number of simultaneous HTTP connections
+MAX_CONNECTIONS_PER_HOST = 8 # Maximum simultaneous connections to one host
+KEEPALIVE_MARGIN = 30 # Seconds idle connections are kept past the timeout
+HTTP_RETRIES = 3 # Times to retry a json request after a connection error
+HTTP_RETRY_BACKOFF = 0.2 # Seconds to wait before the first retry, doubles
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # Bytes read per chunk when saving images
+DIRECT_IO_BUFFER_SIZE = 1 << 20 # Bytes per aligned write when using O_DIRECT
+JSON_CACHE_SIZE = 16 # Number of board thread lists kept for revalidation
 
 # Some default values
 DEF_BOARDS = ['w', 'wg']
@@ -28,93 +42,336 @@ DEF_TIMEOUT = 120
 DEF_IMAGE_FOLDER = "img"
 DEF_MIN_DIMENSION = (1152, 648)
 DEF_MAX_DIMENSION = (DEF_MIN_DIMENSION[0] * 6, DEF_MIN_DIMENSION[1] * 6)
+DEF_MAX_BYTES = 20 * 1024 * 1024
 
 # JSON API and CDN constants
 PROTOCOL = "http"
 API_DOMAIN = "%s://a.4cdn.org" % (PROTOCOL)
-THREAD_JSON_FMT = "%s/{board}/thread/{threadnumber}.json" % (API_DOMAIN)
-BOARD_JSON_FMT = "%s/{board}/threads.json" % (API_DOMAIN)
 IMAGE_DOMAIN = "%s://i.4cdn.org" % (PROTOCOL)
-IMAGE_FMT = "%s/{board}/{filename}{extension}" % (IMAGE_DOMAIN)
 
 #LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
 logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
         datefmt='%Y/%m/%d %H:%M:%S', level=LOG_LEVEL)
 
-def _get_json(url):
+# Shared random number generator used to pick boards, threads and posts
+_RNG = random.Random()
+# Maps url -> (etag, last_modified, json) of recently used board thread
+# lists, least recently used first
+_JSON_CACHE = collections.OrderedDict()
+# Maps image folder -> set of filenames in it, see _files_cache
+_FILES_CACHE = {}
+
+def _board_url(b):
     """
-    Wrapper for requesting data from json API
+    Returns the url of the thread list json for board `b`
     """
-    try:
-        logging.debug("Retrieving: %s" % url)
-        return requests.get(url=url).json()
-    except Exception as e:
-        logging.warning("Error retrieving url %s" % (url))
-        logging.warning("Error: %s" % (str(e)))
+    return f"{API_DOMAIN}/{b}/threads.json"
 
-def _get_random_post(options):
+def _thread_url(b, t):
     """
-    Selects a random board, then selects a random thread on that board, then 
-    returns a post from that thread that has a suitable image or returns 
-    None if no suitable posts are found or False if there is an error.
+    Returns the url of the json for thread number `t` on board `b`
     """
-    min_dimension = options['min_dimension']
-    max_dimension = options['max_dimension']
-    if any(min_dimension[i] > max_dimension[i] for i in range(2)):
-        logging.error("Error: Max dimensions are smaller than min dimensions, "
-                "no images will be able to be found.")
-        return False
-    b = random.choice(options['boards'])
-    t = _get_random_thread(b)
-    if not t:
-        return False
+    return f"{API_DOMAIN}/{b}/thread/{t}.json"
+
+def _image_url(b, tim, ext):
+    """
+    Returns the CDN url of the image `tim` with extension `ext` on board `b`
+    """
+    return f"{IMAGE_DOMAIN}/{b}/{tim}{ext}"
+
+def _create_session(keepalive_timeout=KEEPALIVE_MARGIN):
+    """
+    Creates the HTTP session shared by all requests. Connections to the API
+    and CDN are pooled and kept alive for `keepalive_timeout` seconds so they
+    can be reused between background updates.
+    """
+    import aiohttp # Imported lazily, it is slow to import and unneeded for -h
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=connector)
+
+async def _get_json(session, url, cache=False):
+    """
+    Wrapper for requesting data from json API, connection errors are retried
+    up to HTTP_RETRIES times with exponential backoff. If `cache` is set the
+    response is kept and revalidated with If-None-Match/If-Modified-Since,
+    so an unchanged resource is not downloaded or parsed again while it
+    stays among the JSON_CACHE_SIZE most recently used.
+    """
+    import aiohttp
+    headers = {}
+    cached = cache and _JSON_CACHE.get(url)
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            logging.debug("Retrieving: %s" % url)
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304 and cached:
+                    logging.debug("Not modified: %s" % url)
+                    _JSON_CACHE.move_to_end(url)
+                    return cached[2]
+                r.raise_for_status()
+                json = orjson.loads(await r.read())
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+            if cache and (etag or last_modified):
+                _JSON_CACHE[url] = (etag, last_modified, json)
+                _JSON_CACHE.move_to_end(url)
+                if len(_JSON_CACHE) > JSON_CACHE_SIZE:
+                    _JSON_CACHE.popitem(last=False)
+            elif cache:
+                _JSON_CACHE.pop(url, None)
+            return json
+        except aiohttp.ClientConnectionError as e:
+            error = e
+        except Exception as e:
+            error = e
+            break
+    logging.warning("Error retrieving url %s" % (url))
+    logging.warning("Error: %s" % (str(error)))
+
+def _compile_post_filter(options):
+    """
+    Builds the predicate that decides if a post has a suitable image. The
+    dimension bounds, size limit, DISALLOWED_EXTENSIONS and ALLOW_STICKIES
+    are written into the source as constants, so each test is a single
+    comparison.
+    """
+    min_w, min_h = (int(x) for x in options['min_dimension'][:2])
+    max_w, max_h = (int(x) for x in options['max_dimension'][:2])
+    max_bytes = int(options['max_bytes'])
+    # Most posts have no file, so that test comes first
+    tests = ["'filename' in x"]
+    if DISALLOWED_EXTENSIONS:
+        tests.append("x['ext'] not in {%s}" % ", ".join(
+                repr(str(e)) for e in DISALLOWED_EXTENSIONS))
+    tests.append("%d <= x['w'] <= %d" % (min_w, max_w))
+    tests.append("%d <= x['h'] <= %d" % (min_h, max_h))
+    # The API reports file sizes, so large images are skipped for free
+    tests.append("x['fsize'] <= %d" % (max_bytes))
+    if not ALLOW_STICKIES:
+        tests.append("'sticky' not in x")
+    src = "lambda x: " + " and ".join(tests)
+    logging.debug("Post filter: %s" % src)
+    return eval(src, {})
+
+async def _get_random_post(session, options, seen, b, t):
+    """
+    Returns a post from thread number `t` on board `b` that has a suitable
+    image or returns None if no suitable posts are found or False if there is
+    an error. Posts whose image filename is not in the set `seen` are
+    preferred, if every suitable post is in `seen` one of them is returned
+    with 'downloaded' set.
+    """
+    post_filter = options['_post_filter']
     logging.debug("Looking for images in /%s/ thread #%s" % (b, t))
-    url = THREAD_JSON_FMT.format(board=b, threadnumber=t)
-    json = _get_json(url)
+    url = _thread_url(b, t)
+    json = await _get_json(session, url)
     if not json:
         logging.error('Failed to get thread number %s on board /%s/' % (t, b))
         return False
-    all_image_posts = [x for x in json['posts']
-            if 'filename' in x and
-                ('sticky' not in x or ALLOW_STICKIES) and
-                x['w'] >= min_dimension[0] and
-                x['w'] <= max_dimension[0] and
-                x['h'] >= min_dimension[1] and
-                x['h'] <= max_dimension[1] and
-                x['ext'] not in DISALLOWED_EXTENSIONS]
+    posts = json['posts']
+    def is_new(x):
+        return (post_filter(x) and
+                _md5_to_filename(x['md5']) + x['ext'] not in seen)
+    # Most threads have plenty of suitable images, so checking a few random
+    # posts usually finds one without filtering the whole thread
+    for i in _RNG.sample(range(len(posts)), min(POST_PROBES, len(posts))):
+        if is_new(posts[i]):
+            return {'board': b, 'thread': t, 'post': posts[i],
+                    'downloaded': False}
+    all_image_posts = [x for x in posts if post_filter(x)]
     if not all_image_posts:
         logging.info("Could not find any suitable images in thread #%s on "
                 "/%s/" % (t, b))
-        logging.info("Sleeping %ss to limit API requests" % (SLEEP_FAILURE))
-        time.sleep(SLEEP_FAILURE)
         return None
-    logging.debug("Found %d posts with suitable images in thread #%s "
-            "on /%s/" % (len(all_image_posts), t, b))
-    p = random.choice(all_image_posts)
-    return {'board': b, 'thread': t, 'post': p}
+    new_image_posts = [x for x in all_image_posts if is_new(x)]
+    logging.debug("Found %d posts with suitable images, %d new, in thread "
+            "#%s on /%s/" % (len(all_image_posts), len(new_image_posts), t, b))
+    if not new_image_posts:
+        p = _RNG.choice(all_image_posts)
+        return {'board': b, 'thread': t, 'post': p, 'downloaded': True}
+    p = _RNG.choice(new_image_posts)
+    return {'board': b, 'thread': t, 'post': p, 'downloaded': False}
+
+async def _scan_for_post(session, options, seen):
+    """
+    Searches up to SCAN_WORKERS distinct random threads concurrently and
+    returns the first suitable post found. The thread list of each board
+    searched is fetched once per call. Remaining searches are cancelled once
+    a post is found. Posts with images that are not downloaded yet are
+    preferred, a downloaded one is only returned once every search has
+    finished without finding a new one. Returns None if no suitable posts
+    are found or False if every search that came up empty did so because of
+    an error.
+    """
+    boards = collections.Counter(_RNG.choice(options['boards'])
+            for _ in range(SCAN_WORKERS))
+    # Each board's thread list is fetched once per round, then distinct
+    # threads are picked from it for the searches on that board
+    thread_lists = await asyncio.gather(*(
+            _get_json(session, _board_url(b), cache=True) for b in boards))
+    picks = []
+    for b, json in zip(boards, thread_lists):
+        if not json:
+            logging.error('Failed to get threads for board /%s/' % b)
+            continue
+        picks += [(b, t) for t in _get_random_threads(b, json, boards[b])]
+    if not picks:
+        return False
+    results = []
+    downloaded = None
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_get_random_post(session, options, seen, b, t))
+                for b, t in picks]
+        for next_done in asyncio.as_completed(tasks):
+            post_info = await next_done
+            if post_info and not post_info['downloaded']:
+                for task in tasks:
+                    task.cancel()
+                return post_info
+            if post_info:
+                downloaded = post_info
+            else:
+                results.append(post_info)
+    if downloaded:
+        return downloaded
+    if all(x is False for x in results):
+        return False
+    return None
 
 def _try_create_image_folder(folder):
     """
     Checks if image folder exists, attempts to create it if it does not exist.
     """
     try:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        os.makedirs(folder, exist_ok=True)
     except Exception as e:
         logging.warning("Error: Caught error checking if folder exists")
         logging.warning("Error: %s" % (str(e)))
 
-def _save_image(url, path):
+def _open_direct(path):
     """
-    Downloads image at `url` to `path`
+    Opens `path` for writing with O_DIRECT so the image bypasses the page
+    cache. Returns None if O_DIRECT is unavailable or the filesystem rejects
+    it.
     """
+    if not hasattr(os, 'O_DIRECT'):
+        return None
     try:
-        r = requests.get(url, stream=True)
-        with open(path, 'wb') as f:
-            for chunk in r.iter_content(1024):
-                f.write(chunk)
-    except Exception as e:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                os.O_DIRECT, 0o644)
+    except OSError as e:
+        logging.debug("Could not open %s with O_DIRECT: %s" % (path, e))
+        return None
+
+def _write_all(fd, buf, start, end):
+    """
+    Writes `buf[start:end]` to `fd`, retrying short writes. The view of `buf`
+    is released before returning so `buf` can be closed by the caller.
+    """
+    with memoryview(buf) as view:
+        while start < end:
+            start += os.write(fd, view[start:end])
+
+def _finish_direct(fd, buf, filled):
+    """
+    Writes the first `filled` bytes of `buf` to `fd` and closes it. The page
+    aligned part is written with O_DIRECT, then O_DIRECT is cleared so the
+    unaligned tail can be written.
+    """
+    try:
+        aligned = filled - filled % mmap.PAGESIZE
+        if aligned:
+            _write_all(fd, buf, 0, aligned)
+        if filled > aligned:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            _write_all(fd, buf, aligned, filled)
+    finally:
+        os.close(fd)
+
+async def _write_direct(fd, chunks):
+    """
+    Writes `chunks` to `fd`, which was opened by _open_direct, through a page
+    aligned buffer in DIRECT_IO_BUFFER_SIZE blocks. All writes and the final
+    close run in worker threads so they overlap with network reads and never
+    block the event loop. Closes `fd` when done.
+    """
+    buf = mmap.mmap(-1, DIRECT_IO_BUFFER_SIZE)
+    view = memoryview(buf)
+    filled = 0
+    pending = None # Worker thread call currently using `fd` and `buf`
+    finishing = False # Set once _finish_direct owns closing `fd`
+    try:
+        async for chunk in chunks:
+            chunk = memoryview(chunk)
+            while chunk:
+                n = min(len(chunk), len(view) - filled)
+                view[filled:filled + n] = chunk[:n]
+                chunk = chunk[n:]
+                filled += n
+                if filled == len(view):
+                    pending = asyncio.ensure_future(asyncio.to_thread(
+                            _write_all, fd, buf, 0, filled))
+                    await asyncio.shield(pending)
+                    filled = 0
+        finishing = True
+        pending = asyncio.ensure_future(asyncio.to_thread(
+                _finish_direct, fd, buf, filled))
+        await asyncio.shield(pending)
+    finally:
+        if pending is not None and not pending.done():
+            # Cancelled while a worker is still writing, it has to finish
+            # before `fd` and `buf` can be closed
+            await asyncio.wait([pending])
+            if not pending.cancelled():
+                pending.exception() # Already reported by the cancellation
+        if not finishing:
+            os.close(fd)
+        view.release()
+        buf.close()
+
+async def _save_image(session, url, path, max_bytes):
+    """
+    Downloads image at `url` to `path`, unless the response is larger than
+    `max_bytes`. The file is written with O_DIRECT when possible, otherwise
+    through a regular buffered file. The image is written to `path`.part and
+    renamed once complete, so `path` never holds a partial download.
+    """
+    tmp = path + '.part'
+    try:
+        async with session.get(url) as r:
+            r.raise_for_status()
+            if r.content_length and r.content_length > max_bytes:
+                raise ValueError("Image is %d bytes, the limit is %d bytes" % (
+                        r.content_length, max_bytes))
+            chunks = r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE)
+            fd = _open_direct(tmp)
+            if fd is not None:
+                await _write_direct(fd, chunks)
+            else:
+                import aiofiles
+                async with aiofiles.open(tmp, 'wb') as f:
+                    async for chunk in chunks:
+                        await f.write(chunk)
+        os.replace(tmp, path)
+    except BaseException as e:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        if not isinstance(e, Exception):
+            raise # Cancelled or interrupted, only the cleanup is done here
         logging.warning("Error: Failed to download url %s" % url)
         logging.warning("Error: %s" % (str(e)))
         return False
@@ -129,26 +386,37 @@ def _md5_to_filename(md5):
     """
     return md5[:22].replace('+', '-').replace('/', '_')
 
-def _get_random_image(options):
+async def _get_random_image(session, options, seen):
     """
     Loops until an error occurs or until a post with an image is found. When
     an image is found it is downloaded, the path of the downloaded image is
-    returned. Files are saved with md5 for filename to avoid duplicates.
+    returned. Files are saved with md5 for filename to avoid duplicates, and
+    images whose filename is in the set `seen` are only picked again when no
+    new image is found. The filename of a new download is added to `seen`.
     """
+    min_dimension = options['min_dimension']
+    max_dimension = options['max_dimension']
+    if any(min_dimension[i] > max_dimension[i] for i in range(2)):
+        logging.error("Error: Max dimensions are smaller than min dimensions, "
+                "no images will be able to be found.")
+        return False
+    # A search round makes up to one request per board and one per thread,
+    # so failed rounds sleep SLEEP_FAILURE for each of them
+    sleep_failure = SLEEP_FAILURE * (
+            min(len(options['boards']), SCAN_WORKERS) + SCAN_WORKERS)
     post_info = None
-    path = ""
     logging.info("Starting search for random image")
     while post_info == None:
-        post_info = _get_random_post(options)
-        if not post_info:
-            continue
-        post = post_info['post']
-        path = "{folder}/{filename}{extension}".format(
-                folder=options['image_folder'],
-                filename=_md5_to_filename(post['md5']),
-                extension=post['ext'])
+        post_info = await _scan_for_post(session, options, seen)
+        if post_info == None:
+            logging.info("Sleeping %ss to limit API requests" % (
+                    sleep_failure))
+            await asyncio.sleep(sleep_failure)
     if not post_info:
         return False # False probably means invalid data from user
+    post = post_info['post']
+    path = (f"{options['image_folder']}/{_md5_to_filename(post['md5'])}"
+            f"{post['ext']}")
     logging.info("Found %s%s (%sx%s) in /%s/ post #%s" % (
                     post['tim'], post['ext'], post['w'], post['h'], 
                     post_info['board'], post['no'],)
@@ -156,44 +424,82 @@ def _get_random_image(options):
     if _check_file_exists(path):
         logging.info("Image already downloaded %s" % (path))
         return path
-    _try_create_image_folder(options['image_folder'])
-    url = IMAGE_FMT.format(board=post_info['board'],
-            filename=post['tim'], extension=post['ext'])
-    return _save_image(url, path)
+    url = _image_url(post_info['board'], post['tim'], post['ext'])
+    path = await _save_image(session, url, path, options['max_bytes'])
+    if path:
+        seen.add(os.path.basename(path))
+    return path
 
-def _get_random_thread(b):
+def _get_random_threads(b, json, k):
     """
-    Returns a random thread from the board `b`
+    Returns up to `k` distinct random thread numbers from `json`, the thread
+    list of board `b`
     """
-    url = BOARD_JSON_FMT.format(board=b)
-    json = _get_json(url)
-    if not json:
-        logging.error('Failed to get threads for board /%s/' % b)
-        return False
-    all_threads = [x["no"] for y in json for x in y['threads']]
-    logging.debug("Found %d threads on board /%s/" % (len(all_threads), 
-            b))
-    return random.choice(all_threads)
+    page_sizes = [len(y['threads']) for y in json]
+    total = sum(page_sizes)
+    logging.debug("Found %d threads on board /%s/" % (total, b))
+    if not total:
+        logging.error('No threads found on board /%s/' % b)
+        return []
+    # Picks distinct indices across all pages, then walks the pages to find
+    # them, so every thread is equally likely without flattening all pages
+    threads = []
+    page = offset = 0
+    for i in sorted(_RNG.sample(range(total), min(k, total))):
+        while i >= offset + page_sizes[page]:
+            offset += page_sizes[page]
+            page += 1
+        threads.append(json[page]['threads'][i - offset]["no"])
+    return threads
+
+def _files_cache(folder):
+    """
+    Returns the set of filenames in `folder`. The folder is created if needed
+    and scanned once, after that the set is kept up to date by adding new
+    downloads to it instead of checking the filesystem again. If the folder
+    cannot be listed an empty set is returned and nothing is cached, so the
+    next call tries to create and scan it again.
+    """
+    folder = os.path.normpath(folder)
+    files = _FILES_CACHE.get(folder)
+    if files is None:
+        _try_create_image_folder(folder)
+        try:
+            with os.scandir(folder) as entries:
+                files = {e.name for e in entries if e.is_file()}
+        except OSError as e:
+            logging.warning("Error: Failed to list folder %s" % (folder))
+            logging.warning("Error: %s" % (str(e)))
+            return set()
+        _FILES_CACHE[folder] = files
+    return files
 
 def _check_file_exists(path):
     """
-    Checks if path points to a file that exists.
+    Checks if path points to a file that exists, using the cached listing of
+    its folder instead of a stat call.
     """
-    return os.path.isfile(path)
+    return os.path.basename(path) in _files_cache(os.path.dirname(path))
 
 def set_background(path, options):
     """
     Calls external command (feh) to set background image.
     """
     logging.info("Setting background to %s" % (path))
-    args = " ".join([BG_CHANGE_CMD, options['cmd_scale_option'], path,
-            options['cmd_suffix']])
-    (status, output) = subprocess.getstatusoutput(args)
-    if status != 0:
+    args = [BG_CHANGE_CMD, options['cmd_scale_option'], path]
+    args += shlex.split(options['cmd_suffix'] or '')
+    try:
+        res = subprocess.run(args, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, text=True)
+    except OSError as e:
+        logging.warning("Error: Failed to run command %s" % (shlex.join(args)))
+        logging.warning("Error: %s" % (str(e)))
+        return 127 # Same status a shell reports when it cannot run a command
+    if res.returncode != 0:
         logging.warning("Command subprocess returned non-zero value.")
-        logging.warning("Command: %s" % (args))
-        logging.warning("Output: %s" % (output))
-    return status
+        logging.warning("Command: %s" % (shlex.join(args)))
+        logging.warning("Output: %s" % (res.stdout.rstrip('\n')))
+    return res.returncode
 
 def create_options(options={}):
     """
@@ -201,33 +507,80 @@ def create_options(options={}):
     """
     if 'boards' not in options or not options['boards']:
         options['boards'] = DEF_BOARDS
+    options['boards'] = tuple(options['boards'])
     if 'image_folder' not in options or not options['image_folder']:
         options['image_folder'] = DEF_IMAGE_FOLDER
     if 'min_dimension' not in options or not options['min_dimension']:
         options['min_dimension'] = DEF_MIN_DIMENSION
     if 'max_dimension' not in options or not options['max_dimension']:
         options['max_dimension'] = DEF_MAX_DIMENSION
+    if 'max_bytes' not in options or not options['max_bytes']:
+        options['max_bytes'] = DEF_MAX_BYTES
     if 'cmd_scale_option' not in options or not options['cmd_scale_option']:
         options['cmd_scale_option'] = BG_CHANGE_OPT_FILL
     if 'cmd_suffix' not in options or not options['cmd_suffix']:
         options['cmd_suffix'] = BG_CHANGE_OPT_SUFFIX
+    options['_post_filter'] = _compile_post_filter(options)
     return options
 
-def update_background(options):
+async def _fetch_background(session, options):
     """
-    High level function that will attempt to download an image, then set it as
-    the background image.
+    Attempts to download an image using `session`, returns the path of the
+    image or False if no image could be downloaded.
     """
-    path = _get_random_image(options)
-    if not path:
-        return False
-    file_exists = _check_file_exists(path)
+    seen = _files_cache(options['image_folder'])
+    return await _get_random_image(session, options, seen)
+
+def _apply_background(path, options):
+    """
+    Sets `path` as the background image if the file still exists. The file
+    is checked on disk, not in _files_cache, since it may have been removed
+    after it was downloaded.
+    """
+    file_exists = os.path.isfile(path)
     if not file_exists:
         logging.warning("Error: File doesn't exist (path='%s', "
                 "file_exists=%s)" % (path, file_exists))
+        _files_cache(os.path.dirname(path)).discard(os.path.basename(path))
         return False
     set_background(path, options) # FIle exists and is ready to be used
 
+async def _update_background(session, options):
+    """
+    Attempts to download an image using `session`, then sets it as the
+    background image.
+    """
+    path = await _fetch_background(session, options)
+    if not path:
+        return False
+    return _apply_background(path, options)
+
+def update_background(options):
+    """
+    High level function that will attempt to download an image, then set it as
+    the background image.
+    """
+    async def run():
+        async with _create_session() as session:
+            return await _update_background(session, options)
+    return asyncio.run(run())
+
+async def _run_forever(options, timeout):
+    """
+    Updates the background every `timeout` seconds, reusing one HTTP session
+    so connections stay open between updates. The next image is downloaded
+    while sleeping so it can be set as soon as the timeout ends.
+    """
+    async with _create_session(timeout + KEEPALIVE_MARGIN) as session:
+        next_path = asyncio.create_task(_fetch_background(session, options))
+        while True:
+            path = await next_path
+            next_path = asyncio.create_task(
+                    _fetch_background(session, options))
+            if path:
+                _apply_background(path, options)
+            await asyncio.sleep(timeout)
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Periodically downloads new '
@@ -245,6 +598,9 @@ if __name__ == "__main__":
             help='Space separated maximum width and height for background '
                  'images. (Default --max %s %s)' % (DEF_MAX_DIMENSION[0], 
                      DEF_MAX_DIMENSION[1]))
+    parser.add_argument('--max-bytes', type=int,
+            help='Maximum file size in bytes of images to download. '
+                 '(Default --max-bytes %s)' % (DEF_MAX_BYTES))
     parser.add_argument('-f', '--folder',
             help='Folder for image storage. (Default -f img)')
     group = parser.add_mutually_exclusive_group()
@@ -282,22 +638,21 @@ if __name__ == "__main__":
         scale_option = BG_CHANGE_OPT_FILL
     options = create_options({'boards': args.boards,
             'image_folder': args.folder, 'min_dimension': args_min,
-            'max_dimension': args_max, 'cmd_scale_option': scale_option,
-            'cmd_suffix': args.flags,})
+            'max_dimension': args_max, 'max_bytes': args.max_bytes,
+            'cmd_scale_option': scale_option, 'cmd_suffix': args.flags,})
     cmd_list = [BG_CHANGE_CMD, options['cmd_scale_option'], "<filename>"]
     if options['cmd_suffix']:
         cmd_list.append(options['cmd_suffix'])
     logging.info('Starting chanbg.')
     logging.info('Current settings: timeout: %ss, boards: %s, folder: %s/, '
-            'command: "%s", min_dimension: %s, max_dimension: %s' % (
-                    timeout, options['boards'], options['image_folder'],
+            'command: "%s", min_dimension: %s, max_dimension: %s, '
+            'max_bytes: %s' % (
+                    timeout, list(options['boards']), options['image_folder'],
                     " ".join(cmd_list), options['min_dimension'][:2], 
-                    options['max_dimension'][:2],)
+                    options['max_dimension'][:2], options['max_bytes'],)
             )
     try:
-        while True:
-            update_background(options)
-            time.sleep(timeout)
+        asyncio.run(_run_forever(options, timeout))
     except KeyboardInterrupt as e:
         logging.info("Caught keyboard interrupt, exiting.")
 